@@ -1,4 +1,4 @@
-import subprocess, json
+import subprocess, json, asyncio
 from ipykernel.kernelspec import install as install_ipykernel
 from pathlib import Path
 import sys, os
@@ -6,6 +6,48 @@ import sys, os
 from colorama import init, Fore, Style
 init()
 
+# Packages added to the virtual environment by install_venv, with the version
+# constraint passed to Poetry.  Constraining versions lets Poetry's solver
+# settle quickly instead of searching the full release history of each package.
+# Edit this list to include further packages.
+REQUIRED_PACKAGES = {
+    # Required packages
+    "ipykernel": "^6.29",
+    # Common packages
+    "pandas": "^2.2",
+    "pandasql": "^0.7",
+    "numpy": "^2.0",
+    "pytest": "^8.0",
+    "toml": "^0.10",
+    "pydbtools": "^5.0",
+    "xlsxwriter": "^3.2",
+    "fsspec": ">=2024.6",
+    "s3fs": ">=2024.6",
+    "openpyxl": "^3.1",
+    # Faster pandas readers: pyarrow for CSV, python-calamine for Excel
+    "pyarrow": ">=16.0",
+    "python-calamine": ">=0.2",
+}
+
+# Packages installed directly from GitHub
+GIT_PACKAGES = (
+    # pamo-utilities
+    "git+https://github.com/ministryofjustice/pamo-utilities.git",
+    # pamo-report-builder
+    "git+https://github.com/ministryofjustice/pamo-report-builder.git",
+)
+
+def get_package_specs():
+    """
+    Build the list of package specifications to pass to poetry add.
+    Args: None
+    Returns:
+    package_specs (list): List of name@constraint strings followed by the git packages.
+    """
+    package_specs = [f"{name}@{spec}" for name, spec in REQUIRED_PACKAGES.items()]
+    package_specs.extend(GIT_PACKAGES)
+    return package_specs
+
 def get_venv_for_cwd():
     """
     Find any poetry virtual environments that may match the current working directory.
@@ -15,19 +57,27 @@ def get_venv_for_cwd():
     """
     # Get the current working directory name
     cwd_name = os.path.basename(os.getcwd())
+    matching_folders = []
+    
+    # Virtual environment created in the project folder by install_venv
+    if os.path.isdir(".venv"):
+        matching_folders.append(".venv")
     
     # Path to Poetry virtualenvs cache
     poetry_cache_path = os.path.expanduser("~/.cache/pypoetry/virtualenvs")
     
     # Check if the directory exists
     if not os.path.exists(poetry_cache_path):
-        print("Poetry virtualenvs directory not found. You may need to reinstall the virtual environment.")
+        if not matching_folders:
+            print("Poetry virtualenvs directory not found. You may need to reinstall the virtual environment.")
     else:
         # Search for folders containing the current directory name
-        matching_folders = [
-            folder for folder in os.listdir(poetry_cache_path)
-            if cwd_name in folder and os.path.isdir(os.path.join(poetry_cache_path, folder))
-        ]
+        # scandir gets the file type from the directory listing, avoiding a stat per entry
+        with os.scandir(poetry_cache_path) as entries:
+            matching_folders.extend(
+                entry.name for entry in entries
+                if cwd_name in entry.name and entry.is_dir(follow_symlinks=False)
+            )
     return matching_folders
     
 def install_kernel(kernel_name):
@@ -35,7 +85,8 @@ def install_kernel(kernel_name):
     Installs JupyterLab kernel using installed virtual environment.
     Args: 
     kernel_name (str): Name of kernel to be installed.
-    Returns: None
+    Returns:
+    venv_path (str): Path of the virtual environment the kernel uses.
     """    
     # Install poetry
     subprocess.run(["pip", "install", "poetry"], check=True)
@@ -46,14 +97,26 @@ def install_kernel(kernel_name):
     print("Virtual environment path: ", venv_path)
 
     py = venv_path + "/bin/python"
-    cmd = [py, "-m", "ipykernel", "install", "--user", "--name", kernel_name, "--display-name", display_name]
-    rc, out, err = run(cmd)
     msg = ""
+    if Path(sys.prefix).resolve() == Path(venv_path).resolve():
+        # Already running in the virtual environment so install in-process,
+        # avoiding starting another Python interpreter
+        try:
+            install_ipykernel(user=True, kernel_name=kernel_name, display_name=display_name)
+            rc, out, err = 0, "", ""
+        except Exception as e:
+            rc, out, err = 1, "", str(e)
+        cmd_text = "ipykernel.kernelspec.install"
+    else:
+        # The kernelspec must point at the virtual environment's interpreter
+        cmd = [py, "-m", "ipykernel", "install", "--user", "--name", kernel_name, "--display-name", display_name]
+        rc, out, err = run(cmd)
+        cmd_text = subprocess.list2cmdline(cmd)
     if rc != 0:
-        msg = (
+        msg = (Fore.RED + 
             "Failed to register ipykernel.\n"
-            f"Command: {subprocess.list2cmdline(cmd)}\n"
-            f"STDOUT:\n{out}\nSTDERR:\n{err}"
+            f"Command: {cmd_text}\n"
+            f"STDOUT:\n{out}\nSTDERR:\n{err}" + Style.RESET_ALL
         )
     
     else:
@@ -64,7 +127,8 @@ def install_kernel(kernel_name):
             f"  Python:       {py}\n"
             f"Tip: In JupyterLab, choose Kernel → Change Kernel → '{kernel_name}'." + Style.RESET_ALL
         )
-        print(msg)
+    print(msg)
+    return venv_path
 
 def confirm_overwrite(path: Path) -> bool:
     """
@@ -87,6 +151,19 @@ def confirm_overwrite(path: Path) -> bool:
             os.remove(path)
             return True
 
+def is_poetry_project(path: Path) -> bool:
+    """
+    Check whether a pyproject.toml file has already been set up for poetry.
+    Args:
+    path (path): pyproject.toml file path
+    Returns:
+    Boolean: True if the file exists and is configured for poetry, otherwise False
+    """
+    if not path.exists():
+        return False
+    text = path.read_text()
+    return "[tool.poetry]" in text or "poetry.core.masonry.api" in text
+
 def run(cmd_list):
     """
     Helper to run a command and capture output
@@ -109,60 +186,96 @@ def run(cmd_list):
     except Exception as e:
         return 1, "", str(e)
 
-def install_venv():
+async def run_async(cmd_list, env=None, capture_output=False):
+    """
+    Helper to run a command without blocking the event loop.
+    Args:
+    cmd_list (list): List of command parts to be run.
+    env (dict): Environment variables for the command.  Defaults to the current environment.
+    capture_output (bool): Capture the command output instead of showing it.
+    Returns:
+    str: Command output if captured, otherwise None.
+    Raises:
+    subprocess.CalledProcessError: If the command returns a non-zero exit code.
+    """
+    pipe = asyncio.subprocess.PIPE if capture_output else None
+    proc = await asyncio.create_subprocess_exec(*cmd_list, stdout=pipe, stderr=pipe, env=env)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd_list, stdout, stderr)
+    return stdout.decode().strip() if capture_output else None
+
+async def install_venv():
     """
     Install poetry virtual environment and specified packacges.
     Args: None.
-    Returns: None.
+    Returns:
+    venv_path (str): Path of the installed virtual environment.
     """
-    # Install poetry
-    subprocess.run(["pip", "install", "poetry"], check=True)
+    # Install poetry in the background while the user answers any overwrite prompt
+    print(Fore.GREEN + "Installing poetry..." + Style.RESET_ALL)
+    install_poetry = asyncio.ensure_future(run_async(["pip", "install", "poetry"], capture_output=True))
+    # Only offer to re-initialise pyproject.toml if it isn't already set up for poetry
+    pyproject = Path('pyproject.toml')
+    overwrite = False
+    if not is_poetry_project(pyproject):
+        loop = asyncio.get_running_loop()
+        overwrite = await loop.run_in_executor(None, confirm_overwrite, pyproject)
+    try:
+        await install_poetry
+    except subprocess.CalledProcessError as e:
+        # pip's output was captured so show it before stopping
+        print(Fore.RED + 
+            "Failed to install poetry.\n"
+            f"Command: {subprocess.list2cmdline(e.cmd)}\n"
+            f"STDOUT:\n{e.stdout.decode().strip()}\nSTDERR:\n{e.stderr.decode().strip()}" + Style.RESET_ALL
+        )
+        raise
     
-    # Initialize poetry in the current directory
-    if confirm_overwrite(Path('pyproject.toml')):
-        subprocess.run(["poetry", "init", "--python", ">=3.12,<4.0", "--no-interaction"], check=True)
+    # Create the virtual environment in the project folder (.venv) so it can be
+    # found alongside poetry.lock and cached by CI
+    poetry_env = dict(os.environ, POETRY_VIRTUALENVS_IN_PROJECT="1")
     
-    # Add dependencies - required packages
-    subprocess.run(["poetry", "add", "ipykernel"], check=True)
+    # Initialize poetry in the current directory
+    initialised = False
+    if overwrite:
+        await run_async(["poetry", "init", "--python", ">=3.12,<4.0", "--no-interaction"], env=poetry_env)
+        initialised = True
     
-    # Add dependencies - common packages
-    subprocess.run(["poetry", "add", "pandas"], check=True)
-    subprocess.run(["poetry", "add", "pandasql"], check=True)
-    subprocess.run(["poetry", "add", "numpy"], check=True)
-    subprocess.run(["poetry", "add", "pytest"], check=True)
-    subprocess.run(["poetry", "add", "toml"], check=True)
-    subprocess.run(["poetry", "add", "pydbtools"], check=True)
-    subprocess.run(["poetry", "add", "xlsxwriter"], check=True)
-    subprocess.run(["poetry", "add", "fsspec"], check=True)
-    subprocess.run(["poetry", "add", "s3fs"], check=True)
-    subprocess.run(["poetry", "add", "openpyxl"], check=True)
-
-    # Install pamo-utilities
-    subprocess.run(["poetry", "add", "git+https://github.com/ministryofjustice/pamo-utilities.git"], check=True)
-    # Install pamo-report-builder
-    subprocess.run(["poetry", "add", "git+https://github.com/ministryofjustice/pamo-report-builder.git"], check=True)
+    if Path('poetry.lock').exists() and not initialised:
+        # Install the locked dependencies without re-running the solver
+        print(Fore.GREEN + "\nInstalling packages from poetry.lock..." + Style.RESET_ALL)
+        await run_async(["poetry", "sync", "--no-root"], env=poetry_env)
+    else:
+        # Add all dependencies in a single call so Poetry only resolves and locks once
+        await run_async(["poetry", "add", *get_package_specs()], env=poetry_env)
+        print(Fore.YELLOW + "\nCommit poetry.lock so later installs can skip dependency resolution." + Style.RESET_ALL)
     
-    install_jupyter_kernel()
+    return install_jupyter_kernel()
 
 def install_jupyter_kernel():
     """
     Install a Jupyter kernel for the poetry virtual environment.
     Args: None.
-    Returns: None.
+    Returns:
+    venv_path (str): Path of the virtual environment the kernel uses.
     """
     
     # Install kernel for use by Jupyter notebooks
     print(Fore.GREEN + "\nAdding Jupyter kernel..." + Style.RESET_ALL)
     cwd = Path.cwd().resolve().name
-    install_kernel("pvenv_" + cwd)
+    venv_path = install_kernel("pvenv_" + cwd)
     print(Style.RESET_ALL)
+    return venv_path
 
-def initiate_pvenv_setup():
+async def initiate_pvenv_setup():
     """
     Check if a virtual environment already exists for this working directory.
     Args: None.
-    Returns: None.
+    Returns:
+    venv_path (str): Path of the virtual environment set up, or None if nothing was set up.
     """
+    venv_path = None
     # Present the user with a numbered list of found folders, or reinstall option.
     matching_folders = get_venv_for_cwd()
     if matching_folders:
@@ -178,13 +291,13 @@ def initiate_pvenv_setup():
             if choice == 0:
                 print("You chose to reinstall the virtual environment.")
                 # Reinstall virtual environment
-                install_venv()
+                venv_path = await install_venv()
     
             elif 1 <= choice <= len(matching_folders):
                 selected_folder = matching_folders[choice - 1]
                 print(f"You selected: {selected_folder}")
                 # Activate the virtual environment for the working folder
-                install_jupyter_kernel()
+                venv_path = install_jupyter_kernel()
          
             else:
                 print("Invalid selection.")
@@ -192,17 +305,20 @@ def initiate_pvenv_setup():
             print("Please enter a valid number.")
     else:
         print(Fore.YELLOW + "No matching virtualenv folders found. Installing the virtual environment." + Style.RESET_ALL)
-        install_venv()
+        venv_path = await install_venv()
+    return venv_path
 
 # -----------------------------
 # Entry point
 # -----------------------------
 if __name__ == "__main__":
     # Ensure folder name is appropriate and has no spaces or special characters in it other than hypen or underscore.
-    initiate_pvenv_setup()
+    venv_path = asyncio.run(initiate_pvenv_setup())
 
     # Provide tip for user on how to activate the virtual environment
-    venv_path = subprocess.run(["poetry", "env", "info", "-p"], capture_output=True, text=True).stdout[:-1]
+    # Reuse the path found while installing the kernel rather than starting poetry again
+    if venv_path is None:
+        venv_path = subprocess.run(["poetry", "env", "info", "-p"], capture_output=True, text=True).stdout[:-1]
     print(Fore.YELLOW + "\nActivate the virtual environment by running the command below:\n")
     print("source " + venv_path + "/bin/activate\n\n")  
     print("To subsequently deactivate the environment run the command: \n")
@@ -1,7 +1,29 @@
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_numeric_dtype
 
-def fn_get_mean(df_data_table):
+
+def _numeric_value_table(df_data_table, column):
+    """
+    Make sure the passed column only contains numeric values, converting it if needed.
+    The conversion is skipped when the column is already numeric.  Any conversion goes into a new dataframe so the caller's table isn't changed.
+    
+    Parameters:
+    df_data_table: table of data.
+    column: name of the column that must be numeric.
+    
+    Return:
+    The passed table if the column is already numeric, otherwise a new table with the column converted.
+    """
+    if is_numeric_dtype(df_data_table[column]):
+        return df_data_table
+    try:
+        return df_data_table.assign(**{column: pd.to_numeric(df_data_table[column], errors='raise')})
+    except (ValueError, TypeError) as err:
+        raise ValueError("ERROR - Value column contains non-numeric values.") from err
+
+
+def fn_get_mean(df_data_table, round_to=None):
     """
     Function to calculate the mean of the values for each group in the passed df_data_table
     
@@ -9,6 +31,8 @@ def fn_get_mean(df_data_table):
     df_data_table: a summary table containing a value column plus one or more grouping columns.
         value: contains the value for the respective group.
         other columns: contains the group name/description.  These are used to group the data and calculate means.      
+        Grouping is faster if these are categorical columns, so convert them once with astype('category') when reusing a large table.
+    round_to: optional number of decimal places to round the group means to.  By default means are not rounded.
     
     Return:
     Results dataframe with group columns, group_mean.  
@@ -18,29 +42,24 @@ def fn_get_mean(df_data_table):
     # Make sure range column exists
     if not 'value' in df_data_table.columns:        
         raise KeyError("ERROR - Value column missing.")
-        return None
 
     # Work out which columns should be used to group the data
     # Assumes all passed except value column
-    group_columns = df_data_table.columns.tolist()
-    group_columns.remove('value')
+    group_columns = df_data_table.columns.difference(['value'], sort=False).tolist()
 
      # Make sure group column exists
     if len(group_columns) == 0:        
         raise KeyError("ERROR - No group columns found in passed dataframe.")
-        return None
         
-    # Make sure range column only contains numeric values.  If not, warn user and return nothing.
-    try:
-        df_data_table['value'] = pd.to_numeric(df_data_table['value'], errors='raise')
-    except:
-        raise ValueError("ERROR - Value column contains non-numeric values.")
-        return None
+    # Make sure range column only contains numeric values.  If not, raise an error.
+    df_data = _numeric_value_table(df_data_table, 'value')
     
     # Get mean for group
-    df_results_table = df_data_table.groupby(group_columns).mean().reset_index()
-    # Round results to 2 dp
-    df_results_table.value = df_results_table.value.round(2)
+    # observed=True groups categorical columns on their codes without adding empty category combinations
+    df_results_table = df_data.groupby(group_columns, as_index=False, sort=False, observed=True)['value'].mean()
+    # Round results if requested
+    if round_to is not None:
+        df_results_table['value'] = df_results_table['value'].round(round_to)
     
     return df_results_table, df_data_table
 
@@ -63,39 +82,32 @@ def fn_get_median(df_data_table):
     # Make sure group column exists
     if not 'group' in df_data_table.columns:        
         raise KeyError("ERROR - Group column missing")
-        return None
         
     # Make sure range column exists
     if not 'value' in df_data_table.columns:        
         raise KeyError("ERROR - Value column missing.")
-        return None
                     
-    # Make sure range column only contains numeric values.  If not, warn user and return nothing.
-    try:
-        df_data_table['value'] = pd.to_numeric(df_data_table['value'], errors='raise')
-    except:
-        raise ValueError("ERROR - Value column contains non-numeric values.")
-        return None
+    # Make sure range column only contains numeric values.  If not, raise an error.
+    df_data = _numeric_value_table(df_data_table, 'value')
 
     # Get median for group
-    df_results_table = df_data_table.groupby(['group']).median().reset_index()
-
-    # Make dataframe of rows that make the median
+    grp = df_data.groupby('group', as_index=False, sort=False, observed=True)['value']
+    df_results_table = grp.median()
     df_results_table = df_results_table.rename(columns={'value':'median_value'})
-    df_results_diff = df_data_table.merge(df_results_table[['group', 'median_value']], on='group', how='left')
 
+    # Broadcast each group's median back to its records rather than merging
+    median_values = grp.transform('median')
     # Calculate the deviation from median for each record
-    df_results_diff['deviation'] = abs(df_results_diff.value - df_results_diff.median_value)
-    # Group by deviation and get minimum deviation for each group
-    df_medians = df_results_diff.groupby(['group'])[['deviation']].min().reset_index()
-    # Filter results to get just those on median by merging results
-    df_medians = df_results_diff.merge(df_medians, on=['group', 'deviation'], how='inner')
+    deviation = df_data['value'].sub(median_values).abs()
+    # Filter records to get just those on median (minimum deviation for each group)
+    mask = deviation == deviation.groupby(df_data['group'], sort=False, observed=True).transform('min')
+    df_medians = df_data[mask].assign(median_value=median_values[mask], deviation=deviation[mask]).reset_index(drop=True)
     
     return df_results_table, df_data_table, df_medians
 
 
 # Pay gap function
-def fn_get_pay_gap(df_data_table, comparator_group):
+def fn_get_pay_gap(df_data_table, comparator_group, round_to=None):
     """
     Function to calculate the pay gap between a comparator group and all other groups in the passed df_data_table
     In gender pay gap reporting the comparator group is male.
@@ -106,6 +118,8 @@ def fn_get_pay_gap(df_data_table, comparator_group):
     df_data_table: a summary table of two columns.  
         group: contains the group name/description
         value: contains the mean or median hourly pay rate for the respective group.
+    comparator_group: the group the other groups are compared against.
+    round_to: optional number of decimal places to round the pay gap to.  By default the pay gap is not rounded.
     
     Return:
     Dataframe with columns group, hourly_rate, pay_gap.  
@@ -116,42 +130,78 @@ def fn_get_pay_gap(df_data_table, comparator_group):
     # Make sure group column exists
     if not 'group' in df_data_table.columns:        
         raise KeyError("Group column missing")
-        return None
         
     # Make sure range column exists
     if not 'value' in df_data_table.columns:        
         raise KeyError("Value column missing")
-        return None
         
-    # Make sure range column only contains numeric values.  If not, warn user and return nothing.
-    df_data = df_data_table.copy()
-    try:
-        df_data['value'] = pd.to_numeric(df_data['value'], errors='raise')
-        df_data['value'] = df_data['value'].astype(float)
-    except:
-        raise ValueError("ERROR - Value column contains non-numeric values.")
-        return None
-    
-    # Get comparator record
-    df_comparator = df_data[df_data.group == comparator_group]
+    # Make sure range column only contains numeric values.  If not, raise an error.
+    df_data = _numeric_value_table(df_data_table, 'value')
+    
+    # Get comparator record, building the mask only once
+    values = df_data['value'].to_numpy()
+    comparator_mask = df_data['group'].to_numpy() == comparator_group
     # Confirm only one record
-    if df_comparator.shape[0] == 1:        
-        comparator_group_value = df_data[df_data.group == comparator_group]['value'].values[0]
-        df_data['pay_gap'] = np.nan
-        # Loop through each group in the df_data_table and calculate the gap
-        for row in df_data_table.itertuples():
-            # Get value for the gap group
-            gap_group_value = df_data[df_data.group == row.group]['value'].values[0]
-            # Calculate the pay gap
-            pay_gap = round((comparator_group_value - gap_group_value) / comparator_group_value, 4)
-            # Save the pay gap into the dataframe
-            mask = (df_data.group == row.group)
-            df_data.loc[mask, 'pay_gap'] = pay_gap
+    if comparator_mask.sum() == 1:        
+        comparator_group_value = values[comparator_mask][0]
+        # Calculate the pay gap for every group in one vectorised pass
+        pay_gap = (comparator_group_value - values) / comparator_group_value
+        # Round results if requested
+        if round_to is not None:
+            pay_gap = np.round(pay_gap, round_to)
     else:
         raise ValueError("ERROR - More than one record in data table relating to the specified comparator group.")
     
-    # Return the dataframe with added pay gap column
-    return df_data
+    # Return a new dataframe with added pay gap column
+    return df_data.assign(pay_gap=pay_gap)
+
+
+# Combined pay statistics function
+def fn_get_pay_statistics(df_data_table, comparator_group, round_to=None):
+    """
+    Function to calculate the mean, median and pay gaps for each group in the passed df_data_table in a single grouping pass
+    Gives the same group means and medians as fn_get_mean and fn_get_median, with pay gaps calculated as in fn_get_pay_gap.
+    
+    Parameters:
+    df_data_table: a table of two columns.  
+        group: contains the group name/description
+        value: contains the hourly pay rate for each record.
+    comparator_group: the group the other groups are compared against.
+    round_to: optional number of decimal places to round the pay gaps to.  By default the pay gaps are not rounded.
+    
+    Return:
+    Dataframe with columns group, record_count, mean_value, median_value, mean_pay_gap, median_pay_gap.  
+    """
+
+    # Make sure group column exists
+    if not 'group' in df_data_table.columns:        
+        raise KeyError("Group column missing")
+        
+    # Make sure range column exists
+    if not 'value' in df_data_table.columns:        
+        raise KeyError("Value column missing")
+        
+    # Make sure range column only contains numeric values.  If not, raise an error.
+    df_data = _numeric_value_table(df_data_table, 'value')
+    
+    # Get record count, mean and median for each group from one groupby
+    df_results_table = df_data.groupby('group', sort=False, observed=True)['value'].agg(['count', 'mean', 'median'])
+    df_results_table = df_results_table.rename(columns={'count':'record_count', 'mean':'mean_value', 'median':'median_value'})
+    
+    # Make sure comparator group exists
+    if not comparator_group in df_results_table.index:
+        raise ValueError("ERROR - No records in data table relating to the specified comparator group.")
+    
+    # Calculate the mean and median pay gaps for every group
+    for stat in ['mean', 'median']:
+        comparator_group_value = df_results_table.at[comparator_group, stat + '_value']
+        pay_gap = (comparator_group_value - df_results_table[stat + '_value']) / comparator_group_value
+        # Round results if requested
+        if round_to is not None:
+            pay_gap = pay_gap.round(round_to)
+        df_results_table[stat + '_pay_gap'] = pay_gap
+    
+    return df_results_table.reset_index()
 
 
 def fn_get_quantiles(df_data, range_column, bin_count):
@@ -170,36 +220,44 @@ def fn_get_quantiles(df_data, range_column, bin_count):
     # Make sure range_column exists
     if not range_column in df_data.columns:        
         raise KeyError(range_column + " column missing")
-        return None
         
-    # Make sure range column only contains numeric values.  If not, warn user and return nothing.
-    try:
-        df_data[range_column] = pd.to_numeric(df_data[range_column], errors='raise')
-    except:
-        raise ValueError("ERROR - Value column contains non-numeric values.")
-        return None
+    # Make sure there is at least one quantile to group into
+    if bin_count <= 0:
+        raise ValueError("ERROR - Bin count must be greater than zero.")
+        
+    # Make sure range column only contains numeric values.  If not, raise an error.
+    range_values = _numeric_value_table(df_data, range_column)[range_column]
                                 
-    # Create a dataframe to hold the results
-    df_results_table = pd.DataFrame(columns=['quantile', 'record_count', 'range_min', 'range_max'])
+    values = range_values.to_numpy()
+    record_count = len(values)
+    # Missing values sort to the end so only count towards the last bins' record counts, not their ranges
+    values = values[~pd.isna(values)]
+    valid_count = len(values)
     
-    # Sort table by range_column value ascending
-    df_data = df_data[[range_column]].sort_values(by=[range_column])
+    # Work out the bin boundaries in the sorted order of range_column values.
+    # As with np.array_split the first (record_count % bin_count) bins get one extra record.
+    bin_sizes = np.full(bin_count, record_count // bin_count)
+    bin_sizes[:record_count % bin_count] += 1
+    bin_ends = np.cumsum(bin_sizes)
+    bin_starts = bin_ends - bin_sizes
+    # Bins with no non-missing values have no range
+    range_ends = np.minimum(bin_ends, valid_count)
+    filled = np.flatnonzero(bin_starts < range_ends)
     
-    # Split into bins
-    split_dfs = np.array_split(df_data, bin_count)
-
-    # Access each part and build the output table
-    dict_bins = {}
-    for bin_id in range(0, bin_count):
-        # Split dataframe into chunks
-        dict_bins[bin_id] = split_dfs[bin_id]
-        
-        # Add chunk details to results table
-        new_row = {'quantile': bin_id + 1, 'record_count': dict_bins[bin_id].shape[0], 'range_min': dict_bins[bin_id][range_column].min(), 'range_max': dict_bins[bin_id][range_column].max()}
-        df_results_table.loc[len(df_results_table)] = new_row
+    # Only the values at the bin boundaries need to be in sorted position, so
+    # partition the non-missing values around them rather than sorting every value
+    if valid_count > 0:
+        values = np.partition(values, np.unique(np.concatenate([bin_starts[filled], range_ends[filled] - 1])))
+    
+    # Read each bin's range straight from the boundary values
+    range_min = pd.Series(values[bin_starts[filled]], index=filled).reindex(range(bin_count))
+    range_max = pd.Series(values[range_ends[filled] - 1], index=filled).reindex(range(bin_count))
+    
+    # Build the results table
+    df_results_table = pd.DataFrame({'quantile': np.arange(1, bin_count + 1), 'record_count': bin_sizes, 'range_min': range_min.to_numpy(), 'range_max': range_max.to_numpy()})
     
     # Confirm quantile record count matches number of records we started with
-    if df_results_table.record_count.sum() != df_data.shape[0]:
+    if df_results_table.record_count.sum() != record_count:
         raise ValueError("ERROR - Record count in quantiles doesn't match input data.")
         
     return df_results_table